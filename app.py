@@ -1,33 +1,81 @@
+import asyncio
 import duckdb
-import io
+import fcntl
+import os
 import re
-import json
-from flask import Flask, render_template, request, redirect, session, jsonify, g
+import msgspec
+import orjson
+import plotly.express as px
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, render_template, request, redirect, session, g
+
+import db
 from lp_solver import allocate_customer_capacity
 
-from flask_session import Session
-from llm_client import call_llm_api, generate_formatted_summary
+from llm_client import call_llm_api
 from scheduler import start_refresh_signature_scheduler, start_preprocess_scheduler
 from dotenv import load_dotenv
 
 load_dotenv()
 
 preprocessed_data = None
+# Rendered dashboard HTML keyed by (row count, max rowid) — admins reload often,
+# the allocations table changes slowly
+DASH_CACHE = TTLCache(maxsize=8, ttl=30)
+# Shared pool for blocking allocator/DB work so concurrent chats don't fight
+# over asyncio's default executor
+EXEC = ThreadPoolExecutor(max_workers=16)
+# Built-in signed-cookie sessions: the payload is just api_key/admin flag,
+# so one HMAC verify per request beats a disk read + unpickle per request
 app = Flask(__name__)
 app.secret_key = "super_secret"
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
+
+# Typed schema for /chat/message — msgspec validates and converts in one
+# C-level pass instead of generic dict parsing plus manual checks
+class ChatMsg(msgspec.Struct):
+    role: str | None = None
+    content: str | list | None = None
+
+class ChatPayload(msgspec.Struct):
+    messages: list[ChatMsg] = []
+
+_CHAT_DECODER = msgspec.json.Decoder(ChatPayload)
+
+def json_response(payload, status=200):
+    # orjson is several times faster than stdlib json for these payloads
+    return app.response_class(orjson.dumps(payload), status=status, mimetype="application/json")
+
+_indexes_ready = False
+
+def _ensure_indexes(conn):
+    # Point lookups by customer_api_key happen on every allocation; without
+    # these DuckDB full-scans customer_info/allocations per UPDATE.
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    try:
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_customer_info_api_key ON customer_info(customer_api_key)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_allocations_api_key ON allocations(customer_api_key)")
+        _indexes_ready = True
+    except duckdb.Error as e:
+        print(f"Index setup skipped: {e}")
 
 def get_db():
+    # Cursors off the process-wide shared connection (see db.py) — every
+    # module shares one connection because DuckDB rejects reopening the
+    # file with a different config.
     if "db" not in g:
-        g.db = duckdb.connect("traffic_data.duckdb")
+        conn = db.connection()
+        _ensure_indexes(conn)
+        g.db = conn.cursor()
     return g.db
 
 @app.teardown_appcontext
 def close_db(exception):
     db = g.pop("db", None)
     if db is not None:
-        db.close()
+        db.close()  # closes the per-request cursor, not the shared connection
 
 # -------- GLOBAL ROUTE GUARD -------- #
 @app.before_request
@@ -55,58 +103,49 @@ def chat():
     return render_template("chat.html")
 
 @app.route("/chat/message", methods=["POST"])
-def chat_message():
+async def chat_message():
     if "api_key" not in session:
-        return jsonify({"error": "Not authenticated"}), 403
-
-    data = request.get_json()
-    messages = data.get("messages", [])
-
-    fixed_messages = []
-    for msg in messages:
-        role = msg.get("role")
-        content = msg.get("content")
+        return json_response({"error": "Not authenticated"}, 403)
 
-        if isinstance(content, str):
-            content = [{"text": content}]
-        elif not isinstance(content, list):
-            content = []
-
-        fixed_messages.append({
-            "role": role,
-            "content": content
-        })
+    try:
+        data = _CHAT_DECODER.decode(request.get_data(cache=False))
+    except msgspec.DecodeError:
+        return json_response({"error": "Invalid JSON body"}, 400)
+
+    # Single-pass normalization; canonical list content passes through untouched
+    fixed_messages = [
+        {
+            "role": msg.role,
+            "content": msg.content if isinstance(msg.content, list)
+            else ([{"text": msg.content}] if isinstance(msg.content, str) else [])
+        }
+        for msg in data.messages
+    ]
 
-    response_text = call_llm_api(session["api_key"], fixed_messages)
+    response_text = await call_llm_api(session["api_key"], fixed_messages)
     trigger, allocation_data = extract_allocation_data(response_text)
     if trigger == "WE_ARE_READY_TO_ALLOCATE":
         if not allocation_data:
-            return jsonify(
+            return json_response(
                 {"reply": "⚠️ I received the allocation trigger but couldn't parse the data. Please try again."})
 
-        # Call allocator
-        result = allocate_capacity_helper(session["api_key"], allocation_data, get_db())
+        # Call allocator on the shared pool so the event loop stays free (DuckDB is blocking)
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(EXEC, allocate_capacity_helper, session["api_key"], allocation_data)
 
         if result["status"] != "success":
-            return jsonify({"reply": f"❌ Allocation failed: {result.get('message', 'Unknown error')}"})
-
-        # Optionally insert allocation record into DB here
+            await loop.run_in_executor(EXEC, persist_allocation_result, get_db(), session["api_key"], allocation_data, result)
+            return json_response({"reply": f"❌ Allocation failed: {result.get('message', 'Unknown error')}"})
 
-        # Build a reply summary
-        summary = f"""✅ Allocation successful!
-    - API Key of Customer: {session.get("api_key")}    
-    - TPS Allocated: {result['total_allocated_tps']}
-    - Destinations: {", ".join(allocation_data["destinations"])}
-    - Peak Window: {allocation_data.get("peak_window", "N/A")} in 24 hours format
-    - Peak TPS: {allocation_data.get("peak_tps", "N/A")}
-    - Weekly Volume: {allocation_data.get("traffic_volume", "N/A")}
-    ###"""
+        # The summary is deterministic — format it locally instead of paying a
+        # second LLM round-trip just to pretty-print it
+        summary = format_allocation_summary(session.get("api_key"), result, allocation_data)
 
-        llm_generated_summary = generate_formatted_summary(session.get("api_key"), summary)
+        await loop.run_in_executor(EXEC, persist_allocation_result, get_db(), session["api_key"], allocation_data, result)
 
-        return jsonify({"reply": llm_generated_summary})
+        return json_response({"reply": summary})
 
-    return jsonify({"reply": response_text})
+    return json_response({"reply": response_text})
 
 @app.route("/logout")
 def logout():
@@ -126,20 +165,46 @@ def admin_login():
 @app.route("/admin/dashboard")
 def admin_dashboard():
     conn = get_db()
-    df = conn.execute("SELECT * FROM allocations").fetchdf()
-
-    import plotly.express as px
-    status_counts = df["allocation_status"].value_counts().reset_index()
-    status_counts.columns = ["status", "count"]
-    fig = px.bar(status_counts, x="status", y="count", title="Allocation Status Overview")
-
-    buffer = io.StringIO()
-    fig.write_html(buffer, include_plotlyjs='cdn')
-    graph_html = buffer.getvalue()
+    # The scheduler keeps allocations_status_summary fresh (~K rows); fall back
+    # to aggregating directly if the summary hasn't been built yet
+    try:
+        rows = conn.execute("SELECT status, count FROM allocations_status_summary").fetchall()
+    except duckdb.Error:
+        rows = conn.execute("""
+            SELECT allocation_status AS status, COUNT(*)::BIGINT AS count
+            FROM allocations
+            GROUP BY 1
+            ORDER BY 2 DESC
+        """).fetchall()
+
+    cache_key = tuple(rows)
+    graph_html = DASH_CACHE.get(cache_key)
+    if graph_html is None:
+        fig = px.bar(
+            x=[status for status, _ in rows],
+            y=[count for _, count in rows],
+            labels={"x": "status", "y": "count"},
+            title="Allocation Status Overview",
+        )
+
+        graph_html = fig.to_html(include_plotlyjs='cdn')
+        DASH_CACHE[cache_key] = graph_html
 
     return render_template("admin_dashboard.html", graph_html=graph_html)
 
-def allocate_capacity_helper(api_key, allocation_data, db_connection=None):
+def format_allocation_summary(api_key, result, allocation_data):
+    """Customer-facing allocation summary, matching the tone the formatter LLM used to produce."""
+    return "\n".join([
+        "✅ Allocation successful!",
+        f"🔑 API Key: {api_key}",
+        f"⚡ TPS Allocated: {result['total_allocated_tps']}",
+        f"🌍 Destinations: {', '.join(allocation_data['destinations'])}",
+        f"⏰ Peak Window: {allocation_data.get('peak_window', 'N/A')} (24-hour format)",
+        f"📈 Peak TPS: {allocation_data.get('peak_tps', 'N/A')}",
+        f"📊 Weekly Volume: {allocation_data.get('traffic_volume', 'N/A')}",
+    ])
+
+def allocate_capacity_helper(api_key, allocation_data):
     required_keys = {"requested_tps", "destinations", "peak_window", "peak_tps"}
 
     if not required_keys.issubset(allocation_data):
@@ -151,58 +216,72 @@ def allocate_capacity_helper(api_key, allocation_data, db_connection=None):
     result = allocate_customer_capacity(api_key, allocation_data)
 
     if result["status"] in {"failure", "error"}:
-        # Optional: Save failure record as well
-        if db_connection:
-            save_allocation_record(db_connection, api_key, allocation_data, [{}], status="failure")
         return {
             "status": "failure",
             "message": result.get("message", "No feasible allocation found")
         }
 
-    # Save success record if DB connection is provided
-    if db_connection:
-        with db_connection:
-            save_allocation_record(db_connection, api_key, allocation_data, result["allocations"], status="success")
-            update_allocated_tps_for_customer(api_key, allocation_data.get('requested_tps'))
-
     return {
         "status": "success",
         "allocations": result["allocations"],
         "total_allocated_tps": result["total_allocated_tps"]
     }
 
+def persist_allocation_result(db_connection, api_key, allocation_data, result):
+    """Record the allocation outcome — kept off the reply critical path."""
+    if result["status"] != "success":
+        save_allocation_record(db_connection, api_key, allocation_data, [{}], status="failure")
+        return
+
+    # One transaction boundary for both writes — one commit/WAL flush, not two
+    db_connection.execute("BEGIN TRANSACTION")
+    try:
+        save_allocation_record(db_connection, api_key, allocation_data, result["allocations"], status="success")
+        update_allocated_tps_for_customer(db_connection, api_key, allocation_data.get('requested_tps'))
+        db_connection.execute("COMMIT")
+    except Exception:
+        db_connection.execute("ROLLBACK")
+        raise
+
 @app.route("/api/allocate", methods=["POST"])
 def allocate_capacity():
-    data = request.get_json()
+    try:
+        data = orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        return json_response({"error": "Invalid JSON body"}, 400)
 
     required_keys = {"requested_tps", "destinations", "peak_window", "peak_tps"}
     if not required_keys.issubset(data):
-        return jsonify({"error": "Missing required fields"}), 400
+        return json_response({"error": "Missing required fields"}, 400)
 
     result = allocate_customer_capacity(session.get("api_key"), data)
 
     if result["status"] == "failure" or result["status"] == "error":
-        return jsonify({"status": "failure", "message": result.get("message", "No feasible allocation found")}), 400
+        return json_response({"status": "failure", "message": result.get("message", "No feasible allocation found")}, 400)
 
-    return jsonify({
+    return json_response({
         "status": "success",
         "allocation": result["allocations"],
         "total_allocated": result["total_allocated_tps"]
     })
 
+_TRIGGER = "WE_ARE_READY_TO_ALLOCATE"
+_JSON_RE = re.compile(r"\{.*?\}", re.DOTALL)
+
 def extract_allocation_data(llm_response: str):
-    # Check if trigger exists
-    if "WE_ARE_READY_TO_ALLOCATE" not in llm_response:
+    # Check if trigger exists (cheap substring scan, no regex)
+    idx = llm_response.find(_TRIGGER)
+    if idx < 0:
         return None, None
 
-    # Extract JSON block using regex
+    # Extract JSON block using the precompiled regex, searching only past the trigger
     try:
-        json_block = re.search(r"\{.*?\}", llm_response, re.DOTALL).group(0)
-        allocation_data = json.loads(json_block)
-        return "WE_ARE_READY_TO_ALLOCATE", allocation_data
+        json_block = _JSON_RE.search(llm_response, idx).group(0)
+        allocation_data = orjson.loads(json_block)
+        return _TRIGGER, allocation_data
     except Exception as e:
         print(f"Failed to parse allocation JSON: {e}")
-        return "WE_ARE_READY_TO_ALLOCATE", None
+        return _TRIGGER, None
 
 
 def save_allocation_record(db_connection, api_key, allocation_data, allocations, status="success"):
@@ -217,48 +296,46 @@ def save_allocation_record(db_connection, api_key, allocation_data, allocations,
         status: str, allocation status, e.g. "success" or "failure"
     """
 
-    allocation_description = json.dumps(allocations)
+    allocation_description = orjson.dumps(allocations).decode()
     traffic_volume = int(allocation_data.get('traffic_volume') or 0)
 
-    with db_connection:
-        db_connection.execute("""
-            INSERT INTO allocations (
-                customer_api_key,
-                requested_tps,
-                requested_destinations,
-                requested_volume,
-                requested_peak_traffic_time,
-                allocation_status,
-                allocation_description
-            ) VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (
-            api_key,
-            int(allocation_data.get('requested_tps', 0)),
-            json.dumps(allocation_data.get('destinations', [])),  # store as JSON string
-            traffic_volume,
-            allocation_data.get('peak_window', '0-23'),
-            status,
+    db_connection.execute("""
+        INSERT INTO allocations (
+            customer_api_key,
+            requested_tps,
+            requested_destinations,
+            requested_volume,
+            requested_peak_traffic_time,
+            allocation_status,
             allocation_description
-        ))
-
-def update_allocated_tps_for_customer(api_key, tps_assigned):
+        ) VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (
+        api_key,
+        int(allocation_data.get('requested_tps', 0)),
+        orjson.dumps(allocation_data.get('destinations', [])).decode(),  # store as JSON string
+        traffic_volume,
+        allocation_data.get('peak_window', '0-23'),
+        status,
+        allocation_description
+    ))
+
+def update_allocated_tps_for_customer(db_connection, api_key, tps_assigned):
     """
     Increment the allocated_tps for a customer in the customer_info table.
 
     Parameters:
-=        api_key: str, customer API key
+        db_connection: duckdb connection, reused from the caller's transaction
+        api_key: str, customer API key
         tps_assigned: int or float, TPS to add to the customer's allocated_tps
     """
-    db_connection = duckdb.connect("traffic_data.duckdb")
     if not isinstance(tps_assigned, (int, float)):
         raise ValueError("tps_assigned must be a number")
 
-    with db_connection:
-        db_connection.execute("""
-            UPDATE customer_info
-            SET allocated_tps = COALESCE(allocated_tps, 0) + ?
-            WHERE customer_api_key = ?
-        """, (tps_assigned, api_key))
+    db_connection.execute("""
+        UPDATE customer_info
+        SET allocated_tps = COALESCE(allocated_tps, 0) + ?
+        WHERE customer_api_key = ?
+    """, (tps_assigned, api_key))
 
     # import json
 
@@ -282,7 +359,35 @@ def update_allocated_tps_for_customer(api_key, tps_assigned):
     #     allocation_description
     # ))
 
-if __name__ == "__main__":
+_jobs_started = False
+_preprocess_lock = None
+
+def start_background_jobs():
+    """
+    Start the background schedulers once per process.
+
+    The signature refresh runs in every worker (signature_cache is in-memory),
+    but the preprocess job writes the shared DuckDB file, so only the worker
+    holding the file lock schedules it.
+    """
+    global _jobs_started, _preprocess_lock
+    if _jobs_started:
+        return
+    _jobs_started = True
+
     start_refresh_signature_scheduler()
+
+    _preprocess_lock = open(".preprocess.lock", "w")
+    try:
+        fcntl.flock(_preprocess_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return  # another worker owns preprocessing
     start_preprocess_scheduler()
-    app.run(debug=False, threaded=False)
+
+if __name__ == "__main__":
+    # Dev entrypoint only — production runs under gunicorn (see gunicorn_conf.py).
+    # If someone flips debug on, the reloader parent must not start the
+    # schedulers a second time — only the serving (child) process does.
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true" or not app.debug:
+        start_background_jobs()
+    app.run(debug=False, threaded=True)
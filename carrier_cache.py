@@ -0,0 +1,68 @@
+import ast
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+# How long a cached carrier_profile snapshot stays fresh. Allocations
+# invalidate it explicitly, so the TTL only bounds staleness against the
+# hourly preprocess rebuild.
+TTL_SECONDS = 60
+
+_lock = threading.Lock()
+_snapshot = None
+_loaded_at = 0.0
+
+_PROFILE_QUERY = """
+    SELECT carrier_name,
+           actual_peak_start_time,
+           actual_peak_end_time,
+           allocatable_tps,
+           supported_countries_list
+    FROM carrier_profile
+"""
+
+
+def _clamp_tps(value):
+    # Unparseable values coerce to 0, negatives clamp to 0 — same policy
+    # the allocator applied per request, paid once per snapshot instead
+    try:
+        return max(int(float(value)), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def get_profile(con):
+    """
+    Return a column-oriented snapshot of carrier_profile: plain NumPy arrays
+    straight from DuckDB (no DataFrame boxing) with supported_countries_list
+    pre-parsed into frozensets and allocatable_tps already clamped. The
+    SELECT and the per-row parsing only rerun when the cache expired or was
+    invalidated, not per request.
+    """
+    global _snapshot, _loaded_at
+    with _lock:
+        if _snapshot is not None and time.time() - _loaded_at < TTL_SECONDS:
+            return _snapshot
+        cols = con.execute(_PROFILE_QUERY).fetchnumpy()
+        countries = np.empty(len(cols['supported_countries_list']), dtype=object)
+        countries[:] = [frozenset(ast.literal_eval(s))
+                        for s in cols['supported_countries_list']]
+        _snapshot = SimpleNamespace(
+            names=np.asarray(cols['carrier_name'], dtype=object),
+            peak_starts=np.asarray(cols['actual_peak_start_time'], dtype=np.int32),
+            peak_ends=np.asarray(cols['actual_peak_end_time'], dtype=np.int32),
+            max_allocatable_tps=np.array(
+                [_clamp_tps(v) for v in cols['allocatable_tps']], dtype=np.int64),
+            countries=countries,
+        )
+        _loaded_at = time.time()
+        return _snapshot
+
+
+def invalidate():
+    """Drop the snapshot; the next get_profile re-reads carrier_profile."""
+    global _snapshot
+    with _lock:
+        _snapshot = None
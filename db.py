@@ -0,0 +1,42 @@
+import os
+import threading
+
+import duckdb
+
+DB_PATH = "traffic_data.duckdb"
+
+# Cache parsed database objects across queries and let scans use every core.
+# DuckDB refuses to open the same file twice in one process with different
+# configs, so every module must come through this one connection.
+# If traffic_data.duckdb ever moves to S3/HTTP, add the httpfs metadata-cache
+# settings here too.
+DB_CONFIG = {
+    "enable_object_cache": "true",
+    "threads": str(os.cpu_count()),
+    "memory_limit": "2GB",
+    # None of our queries depend on insertion order, so let aggregation
+    # parallelize without the ordering constraint
+    "preserve_insertion_order": "false",
+}
+
+_DB = None
+_LOCK = threading.Lock()
+
+
+def connection():
+    """
+    The one long-lived read-write connection for this process. Keeps
+    DuckDB's buffer pool and catalog cache warm; callers take cheap
+    cursors off it instead of re-opening the file.
+    """
+    global _DB
+    if _DB is None:
+        with _LOCK:
+            if _DB is None:
+                _DB = duckdb.connect(DB_PATH, config=DB_CONFIG)
+    return _DB
+
+
+def cursor():
+    """A fresh cursor on the shared connection, safe to use per request/job."""
+    return connection().cursor()
@@ -0,0 +1,12 @@
+# Embedded DuckDB allows a single read-write process per database file, so
+# this must stay at one worker — a second process fails with "Could not set
+# lock on file" on its first query. LLM calls are I/O-bound and take seconds
+# each, so concurrency comes from threads instead.
+workers = 1
+worker_class = "gthread"
+threads = 32
+timeout = 120
+
+def post_worker_init(worker):
+    from app import start_background_jobs
+    start_background_jobs()
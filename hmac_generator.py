@@ -1,10 +1,10 @@
 import base64
+import functools
 import logging
 import os
 import hmac
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.DEBUG)
 
 
 class HmacSignatureBuilder:
@@ -20,37 +20,55 @@ class HmacSignatureBuilder:
         self._apiSecret = None
         self._date = None
         self._contentType = None
+        # Encoded join of all non-date fields and an HMAC pre-fed with it;
+        # rebuilt only when one of those fields changes, not per build()
+        self._prefix_bytes = None
+        self._template = None
 
     def set_algorithm(self, algorithm):
         self._algorithm = algorithm
+        self._prefix_bytes = None
+        self._template = None
         return self
 
     def set_host(self, host):
-        self._host = host
+        self._host = host.encode('utf-8') if isinstance(host, str) else host
+        self._prefix_bytes = None
+        self._template = None
         return self
 
     def set_apiKey(self, key):
-        self._apiKey = key
+        self._apiKey = key.encode('utf-8') if isinstance(key, str) else key
+        self._prefix_bytes = None
+        self._template = None
         return self
 
     def set_method(self, method):
-        self._method = method
+        self._method = method.encode('utf-8') if isinstance(method, str) else method
+        self._prefix_bytes = None
+        self._template = None
         return self
 
     def set_resource(self, resource):
-        self._resource = resource
+        self._resource = resource.encode('utf-8') if isinstance(resource, str) else resource
+        self._prefix_bytes = None
+        self._template = None
         return self
 
     def set_contentType(self, contentType):
-        self._contentType = contentType
+        self._contentType = contentType.encode('utf-8') if isinstance(contentType, str) else contentType
+        self._prefix_bytes = None
+        self._template = None
         return self
 
     def set_date(self, dateString):
-        self._date = dateString
+        self._date = dateString.encode('utf-8') if isinstance(dateString, str) else dateString
         return self
 
     def set_nonce(self, nonce):
-        self._nonce = nonce
+        self._nonce = nonce.encode('utf-8') if isinstance(nonce, str) else nonce
+        self._prefix_bytes = None
+        self._template = None
         return self
 
     def set_apiSecret(self, secret):
@@ -58,6 +76,7 @@ class HmacSignatureBuilder:
             self._apiSecret = secret.encode('utf-8')
         else:
             self._apiSecret = secret
+        self._template = None
         return self
 
     def build(self):
@@ -65,40 +84,43 @@ class HmacSignatureBuilder:
                     self._contentType, self._apiKey, self._date]):
             raise ValueError("Missing required fields to build signature")
 
-        digest = hmac.new(self._apiSecret, digestmod=self._algorithm)
-        digest.update(self._method.encode('utf-8'))
-        digest.update(self.DELIMITER)
-        digest.update(self._host.encode('utf-8'))
-        digest.update(self.DELIMITER)
-        digest.update(self._resource.encode('utf-8'))
-        digest.update(self.DELIMITER)
-        digest.update(self._contentType.encode('utf-8'))
-        digest.update(self.DELIMITER)
-        digest.update(self._apiKey.encode('utf-8'))
-        digest.update(self.DELIMITER)
-        if self._nonce is not None:
-            digest.update(self._nonce.encode('utf-8'))
-        digest.update(self.DELIMITER)
-        digest.update(self._date.encode('utf-8'))
+        if self._template is None or self._prefix_bytes is None:
+            self._prefix_bytes = self.DELIMITER.join([
+                self._method,
+                self._host,
+                self._resource,
+                self._contentType,
+                self._apiKey,
+                self._nonce if self._nonce is not None else b'',
+            ]) + self.DELIMITER
+            # Hash the constant prefix once; each build clones the fed
+            # digest and only replays the date suffix
+            self._template = hmac.new(self._apiSecret, self._prefix_bytes,
+                                      digestmod=self._algorithm)
+
+        digest = self._template.copy()
+        digest.update(self._date)
         digest.update(self.DELIMITER)
         digest.update(self.DELIMITER)
 
         signatureBytes = digest.digest()
-        logger.debug("signatureBytes %s", list(signatureBytes))
+        logger.debug("signatureBytes %r", signatureBytes)
         return signatureBytes
 
-    def isHashEquals(self, expectedSignature):
-        signature = self.build()
-        logger.debug("signature : %s", list(signature))
+    def isHashEquals(self, expectedSignature, signature=None):
+        if signature is None:
+            signature = self.build()
+        logger.debug("signature : %r", signature)
         return hmac.compare_digest(signature, expectedSignature)
 
-    def buildAsHexString(self):
-        return self.build().hex().upper()
+    def buildAsHexString(self, signature=None):
+        return (signature or self.build()).hex().upper()
 
-    def buildAsBase64String(self):
-        return base64.b64encode(self.build()).decode('utf-8')
+    def buildAsBase64String(self, signature=None):
+        return base64.b64encode(signature or self.build()).decode('utf-8')
 
 
+@functools.lru_cache(maxsize=16)
 def get_signature(date):
     api_key = os.getenv("API_KEY")
     api_secret = os.getenv("API_SECRET")
@@ -113,8 +135,6 @@ def get_signature(date):
                          .set_apiKey(api_key))
                         .set_apiSecret(api_secret))
 
-
-    sigByte = signatureBuilder.build()
     signature = signatureBuilder.buildAsBase64String()
-    print(signature)
+    logger.debug("signature: %s", signature)
     return signature
\ No newline at end of file
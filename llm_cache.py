@@ -0,0 +1,29 @@
+import hashlib
+import json
+from cachetools import LRUCache
+
+# Repeated chat histories (demo reruns, user retries) hit this instead of the LLM.
+_cache = LRUCache(maxsize=4096)
+
+# Hit/miss counters for eyeballing cache effectiveness in a shell or log line.
+hits = 0
+misses = 0
+
+def make_key(prompt, messages):
+    payload = json.dumps({"prompt": prompt, "messages": messages}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def get(key):
+    global hits, misses
+    reply = _cache.get(key)
+    if reply is None:
+        misses += 1
+    else:
+        hits += 1
+    return reply
+
+def put(key, reply):
+    _cache[key] = reply
+
+def stats():
+    return {"hits": hits, "misses": misses, "size": len(_cache)}
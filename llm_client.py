@@ -1,8 +1,106 @@
+import asyncio
+import functools
+import logging
 import os
-import requests
+import random
+import threading
+import httpx
+import orjson
+import llm_cache
 import signature_cache
 
-def call_llm_api(api_key_from_session, messages, prompt = """You are a helpful and polite support assistant for Vonage, designed to assist customers with additional TPS (Transactions Per Second) capacity requests.
+logger = logging.getLogger(__name__)
+
+# One shared async client so concurrent chat sessions reuse pooled TCP/TLS
+# connections instead of handshaking per call. The transport retries
+# connect-level failures before a request ever reaches the gateway.
+_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(100, connect=5),
+    limits=httpx.Limits(max_connections=10, max_keepalive_connections=10),
+    transport=httpx.AsyncHTTPTransport(retries=2),
+)
+
+# Bounds in-flight gateway requests so a burst of sessions queues instead
+# of overwhelming the provider's rate limit. Created lazily on the I/O loop
+# (a semaphore binds to the loop it first waits on) — see _post_with_retries.
+_sem = None
+
+# Flask's asgiref bridge runs each async view on a fresh, short-lived event
+# loop, so a keep-alive connection opened in one request would be replayed
+# on a dead loop in the next ("Event loop is closed"). All gateway I/O is
+# dispatched to this single long-lived loop instead, which keeps the
+# connection pool (and anything else loop-bound) valid across requests.
+_io_loop = None
+_io_loop_lock = threading.Lock()
+
+
+def _get_io_loop():
+    global _io_loop
+    if _io_loop is None:
+        with _io_loop_lock:
+            if _io_loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="llm-io",
+                                 daemon=True).start()
+                _io_loop = loop
+    return _io_loop
+
+# Transient gateway statuses worth a jittered exponential-backoff retry.
+_RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+_MAX_ATTEMPTS = 4
+
+# Static request fields, built once; only systemPrompt and messages vary
+# between calls.
+# Endpoint config is read once on first use (after the app has loaded
+# .env) instead of via os.getenv on every request.
+_API_URL = None
+_API_KEY_NAME = None
+
+
+def _api_config():
+    global _API_URL, _API_KEY_NAME
+    if _API_KEY_NAME is None:
+        _API_URL = os.getenv("LLM_API_URL")
+        _API_KEY_NAME = os.getenv("API_KEY_NAME", "dev")  # Optional override
+    return _API_URL, _API_KEY_NAME
+
+
+@functools.lru_cache(maxsize=1)
+def build_headers(signature, date):
+    # Built once per signature rotation — the scheduler publishes the result
+    # in the signature_cache snapshot so the hot path just reads a reference
+    _, api_key_name = _api_config()
+    return {
+        "Authorization": f"HmacSHA512 {api_key_name}:XXXX:{signature}",
+        "X-VON-DATE": date,
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+        # Ask the provider to reuse the KV cache for the shared prompt
+        # prefix across turns; ignored by gateways that don't support it
+        "anthropic-beta": "prompt-caching-2024-07-31"
+    }
+
+
+_BASE_PAYLOAD = {
+    "model": {
+        "modelId": "anthropic.claude-3-5-sonnet-20240620-v1:0",
+        "modelRegion": "us-west-2"
+    },
+    "responseFormat": "text",
+    "inferenceConfig": {
+        "stopSequences": ["###"],
+        "maxTokens": 4096,
+        "temperature": 0.7,
+        "topP": 0.9
+    },
+    "additionalModelRequestFields": {
+        "top_k": 400
+    }
+}
+
+# Default conversational system prompt, defined once at module scope so
+# every call shares the same string object (and the same cache key).
+DEFAULT_SYSTEM_PROMPT = """You are a helpful and polite support assistant for Vonage, designed to assist customers with additional TPS (Transactions Per Second) capacity requests.
 
             When a customer starts a conversation, begin by greeting them and asking if they don't give context, ask - “How can I help you today?”
             If they give context of TPS requests, start the flow.
@@ -15,8 +113,8 @@ def call_llm_api(api_key_from_session, messages, prompt = """You are a helpful a
             - What’s your weekly traffic volume? (optional)
 
             Do **not** ask all questions at once—ask them **step-by-step**, focusing on a smooth customer experience.
-            Use WE_ARE_READY_TO_ALLOCATE only if you are done collecting with information, never before that. 
-            
+            Use WE_ARE_READY_TO_ALLOCATE only if you are done collecting with information, never before that.
+
             Once all required information is collected, respond **only once** with:
             1. The keyword `WE_ARE_READY_TO_ALLOCATE` in the first line.
             2. A JSON in the second line containing the structured data, for example:
@@ -27,58 +125,73 @@ def call_llm_api(api_key_from_session, messages, prompt = """You are a helpful a
                 "peak_window": "10-12",
                 "peak_tps": 20
             }
-            
+
             You will return WE_ARE_READY_TO_ALLOCATE only when allocating the request and you have required data.
             If customer request fails due to some reason, they might ask you to try again, then you can give summary of what they have asked for, make edits, get confirmation and try again with WE_ARE_READY_TO_ALLOCATE logic mentioned above.
             After that, if the customer sends any additional messages, reply with a courteous message like: “Thank you! If you need further help with TPS allocation, feel free to ask. 😊”
             Always end every message with ###.
-        """):
-    api_url = os.getenv("LLM_API_URL")
-    api_key_name = os.getenv("API_KEY_NAME", "dev") # Optional override
+        """
+
+
+async def call_llm_api(api_key_from_session, messages, prompt=DEFAULT_SYSTEM_PROMPT):
+    api_url, _ = _api_config()
 
     if not api_url:
         return "LLM_API_URL not set"
 
-    if not (signature_cache.signature and signature_cache.date):
+    # One reference read hands us a consistent (date, signature, headers)
+    # triple even if a refresh lands mid-call
+    snapshot = signature_cache.snapshot
+    if snapshot is None:
         return "Signature not initialized yet."
+    _date, _signature, headers = snapshot
 
-    headers = {
-        "Authorization": f"HmacSHA512 {api_key_name}:XXXX:{signature_cache.signature}",
-        "X-VON-DATE": signature_cache.date,
-        "Content-Type": "application/json",
-        "Accept": "application/json"
-    }
+    cache_key = llm_cache.make_key(prompt, messages)
+    cached_reply = llm_cache.get(cache_key)
+    if cached_reply is not None:
+        return cached_reply
 
-    # Build the payload
-    payload = {
-        "model": {
-            "modelId": "anthropic.claude-3-5-sonnet-20240620-v1:0",
-            "modelRegion": "us-west-2"
-        },
-        "systemPrompt": prompt,
-        "messages": messages,
-        "responseFormat": "text",
-        "inferenceConfig": {
-            "stopSequences": ["###"],
-            "maxTokens": 4096,
-            "temperature": 0.7,
-            "topP": 0.9
-        },
-        "additionalModelRequestFields": {
-            "top_k": 400
-        }
-    }
+    # Merge the per-call fields over the static payload
+    payload = {**_BASE_PAYLOAD, "systemPrompt": prompt, "messages": messages}
 
     try:
-        print("Request Sent: {}", payload)
-        response = requests.post(api_url, json=payload, headers=headers, timeout=(5, 100))
-        response.raise_for_status()
-        return response.json().get("response", "LLM response missing.")
-    except requests.exceptions.RequestException as e:
+        logger.debug("Sending LLM request with %d messages", len(messages))
+        body = orjson.dumps(payload)
+        # Run the HTTP exchange on the persistent I/O loop and await its
+        # result from the request's own loop
+        reply = await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(
+            _post_with_retries(api_url, body, headers), _get_io_loop()))
+        # Never cache allocation triggers — those must always hit the allocator fresh
+        if "WE_ARE_READY_TO_ALLOCATE" not in reply:
+            llm_cache.put(cache_key, reply)
+        return reply
+    except httpx.HTTPError as e:
         return f"Error calling LLM API: {str(e)}"
 
 
-def generate_formatted_summary(api_key, raw_summary):
+async def _post_with_retries(api_url, body, headers):
+    # Always runs on the I/O loop — _client and _sem must only be touched here
+    global _sem
+    if _sem is None:
+        # First use; the I/O loop is single-threaded, so no lock is needed
+        _sem = asyncio.Semaphore(int(os.getenv("LLM_MAX_CONCURRENCY", "10")))
+    response = None
+    for attempt in range(_MAX_ATTEMPTS):
+        try:
+            async with _sem:
+                response = await _client.post(api_url, content=body, headers=headers)
+            if response.status_code not in _RETRY_STATUSES:
+                break
+        except httpx.TimeoutException:
+            if attempt == _MAX_ATTEMPTS - 1:
+                raise
+        if attempt < _MAX_ATTEMPTS - 1:
+            await asyncio.sleep(min(16, 2 ** attempt) * (0.5 + random.random()))
+    response.raise_for_status()
+    return response.json().get("response", "LLM response missing.")
+
+
+async def generate_formatted_summary(api_key, raw_summary):
     # System prompt specifically for formatting
     formatting_prompt = """
     You are a customer-friendly assistant.
@@ -89,13 +202,19 @@ def generate_formatted_summary(api_key, raw_summary):
     Always end the message with ###
     """
 
+    # Short summaries that already carry their own formatting don't need a
+    # second LLM round-trip just to be prettified
+    stripped = raw_summary.strip()
+    if len(stripped) < 400 and ('•' in stripped or stripped.startswith('-') or '|' in stripped):
+        return stripped.rstrip('#').strip()
+
     # Messages to send to the LLM (no need for system role inside the message array)
     pretty_messages = [
         {"role": "user", "content": [{"text": raw_summary}]}
     ]
 
     # Use the enhanced call_llm_api with custom prompt
-    pretty_response = call_llm_api(api_key, pretty_messages, prompt=formatting_prompt)
+    pretty_response = await call_llm_api(api_key, pretty_messages, prompt=formatting_prompt)
 
     # Clean up LLM's ending syntax
     return pretty_response.strip().rstrip('#').strip()
@@ -1,140 +1,177 @@
-import ast
 import duckdb
+import logging
+from dataclasses import dataclass
 from scipy.optimize import linprog
+from scipy.sparse import csr_matrix
 import numpy as np
-import pandas as pd
 
-pd.set_option('display.max_columns', None)  # Show all columns
-pd.set_option('display.width', None)        # Don't wrap lines
-
-
-def allocate_customer_capacity(customer_api_key, request: dict):
-    con = duckdb.connect('traffic_data.duckdb')
-
-    profile_df = con.execute("""
-        SELECT carrier_name, 
-               allowed_tps AS profile_allowed_tps, 
-               avg_tps_actual AS profile_actual_tps, 
-               actual_peak_start_time, 
-               actual_peak_end_time, 
-               allocatable_tps,
-               supported_countries_list 
-        FROM carrier_profile
-    """).fetchdf()
-
-    profile_df['supported_countries_list'] = profile_df['supported_countries_list'].apply(ast.literal_eval)
-
-    # Filter carriers that support at least one requested destination country
-    filtered_carriers = profile_df[
-        profile_df['supported_countries_list'].apply(
-            lambda countries: any(dest in countries for dest in request['destinations'])
+import carrier_cache
+import db
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class NormalizedRequest:
+    """
+    Allocation request with the string fields parsed exactly once. Retries
+    of the same request reuse the parsed form instead of re-splitting
+    peak_window and re-walking the destination list, and the frozen fields
+    make the request hashable if allocation results ever get cached.
+    """
+    requested_tps: float
+    destinations: tuple
+    destination_set: frozenset
+    start: int
+    end: int
+    demand_per_dest: float
+
+    @classmethod
+    def from_dict(cls, request):
+        destinations = tuple(request['destinations'])
+        start_str, end_str = request.get('peak_window', '0-23').split('-')
+        requested_tps = float(request['requested_tps'])
+        return cls(
+            requested_tps=requested_tps,
+            destinations=destinations,
+            destination_set=frozenset(destinations),
+            start=int(start_str),
+            end=int(end_str),
+            demand_per_dest=requested_tps / len(destinations) if destinations else 0.0,
         )
-    ].copy()
-
-    if filtered_carriers.empty:
-        return {'status': 'error', 'message': 'No carriers found supporting the requested destinations'}
-
-    def compute_allocatable_tps(row):
-        try:
-            allocatable_tps = int(row['allocatable_tps'])
-            return max(0, allocatable_tps)
-        except Exception as e:
-            print(f"Row error: {row.to_dict()}, Error: {e}")
-            return 0
-
-    filtered_carriers['max_allocatable_tps'] = filtered_carriers.apply(compute_allocatable_tps, axis=1)
-
-    if filtered_carriers.empty:
-        return {'status': 'error', 'message': 'No carriers found supporting the requested TPS'}
-
-    # New filter: peak time overlap
-
-    requested_start_str, requested_end_str = request.get('peak_window', '0-23').split('-')
-    requested_start = int(requested_start_str)
-    requested_end = int(requested_end_str)
 
-    def peak_time_overlaps(row):
-        carrier_start = int(row['actual_peak_start_time'])
-        carrier_end = int(row['actual_peak_end_time'])
-        # Check if time windows overlap (simple numeric overlap)
-        return not (carrier_end <= requested_start or carrier_start >= requested_end)
-
-    filtered_carriers = filtered_carriers[filtered_carriers.apply(peak_time_overlaps, axis=1)]
-
-    if filtered_carriers.empty:
-        return {'status': 'error', 'message': 'No carriers found supporting the requested peak times'}
-
-    print("Filtered by country and peak time:")
-    print(filtered_carriers)
-
-    tps_limits = filtered_carriers['max_allocatable_tps'].values
-    num_carriers = len(filtered_carriers)
-    destinations = request['destinations']
-    num_dest = len(destinations)
+def _build_lp(req, supported_countries, tps_limits):
+    """
+    Build the LP inputs (objective, constraints, bounds) as preallocated
+    NumPy arrays so linprog gets ndarrays instead of nested Python lists.
+    """
+    num_carriers = len(tps_limits)
+    num_dest = len(req.destinations)
 
     # Objective: minimize total allocated TPS (or any other objective)
-    c = [1.0] * num_carriers
+    c = np.ones(num_carriers)
 
     # Equality constraint: sum of allocations = requested TPS
-    A_eq = [ [1.0]*num_carriers ]
-    b_eq = [request['requested_tps']]
-
-    # Inequality constraints for each destination:
-    # For each destination d, sum of allocations from carriers supporting d >= demand_per_dest
-    demand_per_dest = request['requested_tps'] / num_dest
-
-    A_ub = []
-    b_ub = []
-
-    # For linprog, inequalities are A_ub x <= b_ub
-    # So to encode sum of allocations for d >= demand_per_dest
-    # we rewrite as -sum >= -demand_per_dest => sum <= demand_per_dest with negative sign flipped
-
-    for d in destinations:
-        row = []
-        for idx, countries in enumerate(filtered_carriers['supported_countries_list']):
-            # If carrier supports d, coefficient is -1 (to flip inequality), else 0
-            row.append(-1.0 if d in countries else 0.0)
-        A_ub.append(row)
-        b_ub.append(-demand_per_dest)
+    A_eq = csr_matrix(np.ones((1, num_carriers)))
+    b_eq = np.array([req.requested_tps], dtype=np.float64)
+
+    # Inequality constraints: for each destination d, the carriers supporting d
+    # must together cover demand_per_dest. linprog wants A_ub x <= b_ub, so the
+    # >= constraint is encoded with flipped signs. Most carriers support only
+    # a few countries, so the matrix goes to HiGHS sparse as-is.
+    rows = []
+    cols = []
+    for i, d in enumerate(req.destinations):
+        for j, countries in enumerate(supported_countries):
+            if d in countries:
+                rows.append(i)
+                cols.append(j)
+    A_ub = csr_matrix((np.full(len(rows), -1.0), (rows, cols)),
+                      shape=(num_dest, num_carriers))
+    b_ub = np.full(num_dest, -req.demand_per_dest)
+
+    bounds = np.column_stack([np.zeros(num_carriers), np.asarray(tps_limits, dtype=np.float64)])
+    return c, A_ub, b_ub, A_eq, b_eq, bounds
+
+
+def allocate_customer_capacity(customer_api_key, request):
+    # Parse peak_window/destinations/requested_tps once up front; dict
+    # callers get normalized here, retries can pass the parsed form directly
+    req = request if isinstance(request, NormalizedRequest) else NormalizedRequest.from_dict(request)
+
+    # Cursor on the process-wide shared connection (db.py); opening the file
+    # here with a different config would make DuckDB refuse the connection
+    con = db.cursor()
+
+    # Pre-parsed NumPy snapshot (names/caps/peaks arrays, frozenset country
+    # lists), shared across requests — no DataFrame in the hot path
+    profiles = carrier_cache.get_profile(con)
+
+    # Filter carriers that support at least one requested destination country;
+    # the cached column holds frozensets, so this is one hash-based
+    # disjointness check per row
+    country_mask = np.fromiter(
+        (not req.destination_set.isdisjoint(countries) for countries in profiles.countries),
+        dtype=bool, count=len(profiles.countries))
+
+    if not country_mask.any():
+        return {'status': 'error', 'message': 'No carriers found supporting the requested destinations'}
 
-    bounds = [(0, tps_limits[i]) for i in range(num_carriers)]
+    # New filter: peak time overlap
 
-    result = linprog(c=c, A_ub=A_ub, b_ub=b_ub, A_eq=A_eq, b_eq=b_eq, bounds=bounds, method='highs')
+    # Window-overlap check as one boolean mask over int arrays instead of
+    # a Python call per row
+    keep = country_mask & ~((profiles.peak_ends <= req.start) |
+                            (profiles.peak_starts >= req.end))
 
-    if not result.success:
-        return {'status': 'error', 'message': 'Could not allocate TPS under given constraints'}
+    if not keep.any():
+        return {'status': 'error', 'message': 'No carriers found supporting the requested peak times'}
 
-    allocations = []
-    for idx, tps in enumerate(result.x):
-        if tps > 0:
-            allocations.append({
-                'carrier': filtered_carriers.iloc[idx]['carrier_name'],
-                'allocated_tps': round(float(tps), 2)
-            })
+    names = profiles.names[keep]
+    caps = profiles.max_allocatable_tps[keep].astype(np.float64)
+    supported = profiles.countries[keep]
+
+    logger.debug("Filtered by country and peak time: %s", names)
+
+    if all(req.destination_set <= countries for countries in supported):
+        # Every remaining carrier covers the whole destination set, so any
+        # split summing to requested_tps satisfies the per-destination
+        # coverage rows — greedily fill the largest capacities and skip the
+        # LP solve entirely
+        if caps.sum() < req.requested_tps:
+            return {'status': 'error', 'message': 'Could not allocate TPS under given constraints'}
+        order = np.argsort(caps)[::-1]
+        prior = np.concatenate(([0.0], np.cumsum(caps[order])[:-1]))
+        x = np.empty_like(caps)
+        x[order] = np.clip(req.requested_tps - prior, 0, caps[order])
+    else:
+        c, A_ub, b_ub, A_eq, b_eq, bounds = _build_lp(req, supported, caps)
+
+        result = linprog(c=c, A_ub=A_ub, b_ub=b_ub, A_eq=A_eq, b_eq=b_eq, bounds=bounds, method='highs')
+
+        if not result.success:
+            return {'status': 'error', 'message': 'Could not allocate TPS under given constraints'}
+        x = result.x
+
+    # One mask over the solution vector picks the funded carriers
+    mask = x > 1e-9
+    allocations = [
+        {'carrier': name, 'allocated_tps': round(float(tps), 2)}
+        for name, tps in zip(names[mask], x[mask])
+    ]
 
     #Success Scenario
     update_allocatable_tps(con, allocations)
 
     return {
         'status': 'success',
-        'total_requested_tps': int(request['requested_tps']),
-        'total_allocated_tps': round(float(sum(result.x)), 2),
+        'total_requested_tps': int(req.requested_tps),
+        'total_allocated_tps': round(float(x.sum()), 2),
         'allocations': allocations
     }
 
 
 def update_allocatable_tps(con, allocations):
-    for allocation in allocations:
-        carrier = allocation['carrier']
-        allocated_tps = allocation['allocated_tps']
-
-        # Subtract allocated TPS from allocatable_tps
-        con.execute(f"""
+    if not allocations:
+        return
+
+    # One parameterized, transactional batch instead of a parse/plan and
+    # autocommit flush per carrier (also keeps carrier names out of the SQL)
+    rows = [(a['allocated_tps'], a['carrier']) for a in allocations]
+    con.execute("BEGIN TRANSACTION")
+    try:
+        con.executemany("""
             UPDATE carrier_profile
-            SET allocatable_tps = GREATEST(allocatable_tps - {allocated_tps}, 0)
-            WHERE carrier_name = '{carrier}'
-        """)
+            SET allocatable_tps = GREATEST(allocatable_tps - ?, 0)
+            WHERE carrier_name = ?
+        """, rows)
+        con.execute("COMMIT")
+    except duckdb.Error:
+        con.execute("ROLLBACK")
+        raise
+
+    # The cached profile snapshot now has stale allocatable_tps values
+    carrier_cache.invalidate()
 
 # def main():
 #     request = {
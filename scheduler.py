@@ -2,24 +2,56 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from email.utils import formatdate
 from hmac_generator import get_signature
 from data_analyst import preprocess_data
+import db
+import llm_client
 import signature_cache
 
+# One scheduler (and one executor thread pool) per process. The start_*
+# functions below just register jobs on it — app.py still decides which
+# worker schedules what. coalesce/max_instances keep a slow preprocess run
+# from stacking up behind itself; missed ticks within a minute still fire.
+_scheduler = BackgroundScheduler(
+    job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": 60}
+)
+
+def _ensure_started():
+    if not _scheduler.running:
+        _scheduler.start()
+
 def refresh_signature():
     date = formatdate(timeval=None, localtime=False, usegmt=True)
     signature = get_signature(date)
-    signature_cache.date = date
-    signature_cache.signature = signature
+    # Publish date, signature and the ready-to-send headers as one atomic
+    # snapshot so no request can pair a fresh date with a stale signature
+    signature_cache.publish(date, signature, llm_client.build_headers(signature, date))
     print(f"Signature refreshed at {date}")
 
 def start_refresh_signature_scheduler():
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(refresh_signature, "interval", minutes=15)
+    _scheduler.add_job(refresh_signature, "interval", minutes=15)
     refresh_signature()  # Initial call
-    scheduler.start()
+    _ensure_started()
+
 
+def refresh_allocation_summary():
+    # Amortizes the allocations scan across scheduler ticks so the admin
+    # dashboard reads one row per status instead of aggregating per request.
+    # Cursor on the shared connection — a fresh default-config connect would
+    # clash with db.DB_CONFIG and fail once the app connection exists.
+    conn = db.cursor()
+    try:
+        conn.execute("""
+            CREATE OR REPLACE TABLE allocations_status_summary AS
+            SELECT allocation_status AS status, COUNT(*)::BIGINT AS count
+            FROM allocations
+            GROUP BY 1
+            ORDER BY 2 DESC
+        """)
+    finally:
+        conn.close()
 
 def start_preprocess_scheduler():
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(preprocess_data, "interval", hours=1)
+    _scheduler.add_job(preprocess_data, "interval", hours=1)
+    _scheduler.add_job(refresh_allocation_summary, "interval", seconds=30)
     preprocess_data()
-    scheduler.start()
\ No newline at end of file
+    refresh_allocation_summary()
+    _ensure_started()
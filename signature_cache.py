@@ -1,2 +1,15 @@
-signature = None
-date = None
\ No newline at end of file
+import threading
+
+# Immutable (date, signature, headers) triple published in a single
+# assignment, so readers can never observe a fresh date paired with a stale
+# signature. Readers grab the whole tuple lock-free (object-reference
+# assignment is atomic under the GIL); writers serialize on the lock.
+snapshot = None
+refresh_lock = threading.Lock()
+
+
+def publish(date, signature, headers):
+    """Swap in a new snapshot atomically."""
+    global snapshot
+    with refresh_lock:
+        snapshot = (date, signature, headers)